@@ -1,20 +1,42 @@
 import asyncio
-import base64
+import hashlib
 import io
 import logging
 import os
+import secrets
 import signal
+from collections import OrderedDict
 
 import google.generativeai as genai
-from telegram import Update, BotCommand
+import numpy as np
+import orjson
+import pybase64
+import uvloop
+from telegram import Update, BotCommand, InputMediaPhoto
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
 from PIL import Image
 from aiohttp import web
+from turbojpeg import TurboJPEG, TJFLAG_FASTDCT, TJPF_RGB, TJSAMP_420
 
 # --- Configuration ---
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 PORT = int(os.environ.get('PORT', 8080))
+# Set automatically by Render; when missing (e.g. running locally) the bot falls back to polling
+RENDER_HOST = os.getenv('RENDER_EXTERNAL_HOSTNAME')
+WEBHOOK_PATH = '/telegram'
+# Telegram echoes this back on every webhook call so we can reject forged updates
+WEBHOOK_SECRET = secrets.token_urlsafe(32)
+JPEG_MAGIC = b'\xff\xd8\xff'
+# Telegram recompresses photos anyway, so 4:2:0 at quality 85 is plenty
+JPEG_QUALITY = 85
+PROMPT_CACHE_SIZE = 1024
+
+# Maps a normalized prompt hash to the Telegram file_id of the photo we sent for it.
+# Re-sending an existing file_id needs no upload and no new generation.
+_CACHE: "OrderedDict[str, str]" = OrderedDict()
 
 # --- Set up Logging ---
 logging.basicConfig(
@@ -23,87 +45,159 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# --- Set up libjpeg-turbo (falls back to Pillow if the library is missing) ---
+try:
+    _jpeg = TurboJPEG()
+except Exception as e:
+    logger.warning(f"libjpeg-turbo not available, using Pillow for JPEG encoding: {e}")
+    _jpeg = None
+
 # --- Configure the Gemini API ---
 try:
     if not GEMINI_API_KEY:
         raise ValueError("GEMINI_API_KEY environment variable not set.")
     genai.configure(api_key=GEMINI_API_KEY)
+    IMAGEN_MODEL = genai.GenerativeModel('imagen-3.0-generate-002')
     logger.info("Gemini API configured successfully.")
 except Exception as e:
     logger.error(f"Failed to configure Gemini API: {e}")
     exit()
 
-# --- Bot Command Handlers (No changes in this section) ---
+# --- Static Replies ---
+WELCOME_TEMPLATE = (
+    "👋 Hi {name}!\n\n"
+    "I'm an image generation bot. Just send me a text description, "
+    "and I'll create an image for you.\n\n"
+    "For example, try sending:\n"
+    "🎨 `A futuristic cityscape at sunset`\n"
+    "🚀 `A corgi astronaut floating in space`"
+)
+
+HELP_TEXT = (
+    "Here's how to use me:\n\n"
+    "1. Simply type a description of the image you want to create.\n"
+    "2. I will generate it and send it back to you.\n\n"
+    "Tips for good prompts:\n"
+    "✅ Be descriptive! (e.g., 'A hyperrealistic photo of a red sports car...')\n"
+    "✅ Include styles (e.g., 'in the style of Van Gogh', 'as a 3D render').\n"
+    "✅ Mention lighting or mood (e.g., 'dramatic lighting', 'a peaceful morning')."
+)
+
+ERROR_TEXT = (
+    "😥 Sorry, something went wrong.\n\n"
+    "This could be because the prompt was unsafe or the service is busy. "
+    "Please try a different prompt."
+)
+
+# --- Bot Command Handlers ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_name = update.effective_user.first_name
-    welcome_message = (
-        f"👋 Hi {user_name}!\n\n"
-        "I'm an image generation bot. Just send me a text description, "
-        "and I'll create an image for you.\n\n"
-        "For example, try sending:\n"
-        "🎨 `A futuristic cityscape at sunset`\n"
-        "🚀 `A corgi astronaut floating in space`"
-    )
-    await update.message.reply_text(welcome_message)
+    await update.message.reply_text(WELCOME_TEMPLATE.format(name=user_name))
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    help_text = (
-        "Here's how to use me:\n\n"
-        "1. Simply type a description of the image you want to create.\n"
-        "2. I will generate it and send it back to you.\n\n"
-        "Tips for good prompts:\n"
-        "✅ Be descriptive! (e.g., 'A hyperrealistic photo of a red sports car...')\n"
-        "✅ Include styles (e.g., 'in the style of Van Gogh', 'as a 3D render').\n"
-        "✅ Mention lighting or mood (e.g., 'dramatic lighting', 'a peaceful morning')."
-    )
-    await update.message.reply_text(help_text)
+    await update.message.reply_text(HELP_TEXT)
+
+def _transcode(image_bytes: bytes) -> bytes:
+    """Convert the generated image to RGB JPEG bytes."""
+    if _jpeg is not None:
+        img = Image.open(io.BytesIO(image_bytes))
+        # libjpeg-turbo cannot convert CMYK/YCCK to RGB, so only hand it L/RGB JPEGs
+        if image_bytes[:3] == JPEG_MAGIC and img.mode in ('L', 'RGB'):
+            arr = _jpeg.decode(image_bytes, pixel_format=TJPF_RGB)
+        else:
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            arr = np.asarray(img)
+        return _jpeg.encode(
+            arr,
+            quality=JPEG_QUALITY,
+            pixel_format=TJPF_RGB,
+            jpeg_subsample=TJSAMP_420,
+            flags=TJFLAG_FASTDCT
+        )
+
+    img = Image.open(io.BytesIO(image_bytes))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    bio = io.BytesIO()
+    img.save(bio, 'JPEG', quality=JPEG_QUALITY, subsampling=2, optimize=False)
+    return bio.getvalue()
+
+def _prompt_key(prompt: str) -> str:
+    return hashlib.blake2b(prompt.strip().lower().encode(), digest_size=16).hexdigest()
 
 async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     prompt = update.message.text
     if not prompt:
         return
 
+    bot = context.bot
     chat_id = update.effective_chat.id
-    logger.info(f"Received prompt from chat {chat_id}: '{prompt}'")
 
-    processing_message = await context.bot.send_message(
+    logger.info("Received prompt from chat %s (%d chars)", chat_id, len(prompt))
+
+    key = _prompt_key(prompt)
+    file_id = _CACHE.get(key)
+    if file_id is not None:
+        # Refresh before awaiting; other handlers may evict the key meanwhile
+        _CACHE.move_to_end(key)
+        try:
+            await bot.send_photo(chat_id=chat_id, photo=file_id)
+            return
+        except BadRequest as e:
+            logger.warning(f"Cached photo could not be re-sent, generating a new one: {e}")
+            if _CACHE.get(key) == file_id:
+                del _CACHE[key]
+        except TelegramError as e:
+            # The photo may or may not have arrived; don't risk sending a second one
+            logger.error(f"An error occurred while re-sending a cached photo: {e}")
+            await bot.send_message(chat_id=chat_id, text=ERROR_TEXT)
+            return
+
+    processing_message = await bot.send_message(
         chat_id=chat_id,
         text="🎨 Generating your image, please wait a moment..."
     )
+    msg_id = processing_message.message_id
 
     try:
-        model = genai.GenerativeModel('imagen-3.0-generate-002')
-        response = await model.generate_content_async(prompt, generation_config={"sample_count": 1})
+        response = await IMAGEN_MODEL.generate_content_async(prompt, generation_config={"sample_count": 1})
         
         base64_image_data = response.candidates[0].content.parts[0].inline_data.data
-        image_bytes = base64.b64decode(base64_image_data)
+        image_bytes = pybase64.b64decode(base64_image_data, validate=True)
         
-        img = Image.open(io.BytesIO(image_bytes))
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
+        if image_bytes[:3] == JPEG_MAGIC and Image.open(io.BytesIO(image_bytes)).mode == 'RGB':
+            # Already an RGB JPEG, send it as-is without re-encoding
+            jpeg_bytes = image_bytes
+        else:
+            # Codec work is CPU-bound, keep it off the event loop
+            jpeg_bytes = await asyncio.to_thread(_transcode, image_bytes)
 
-        bio = io.BytesIO()
-        bio.name = 'image.jpeg'
-        img.save(bio, 'JPEG')
-        bio.seek(0)
+        # Swap the placeholder message for the photo in a single API call
+        message = await bot.edit_message_media(
+            chat_id=chat_id,
+            message_id=msg_id,
+            media=InputMediaPhoto(media=jpeg_bytes, filename='image.jpeg')
+        )
 
-        await context.bot.send_photo(chat_id=chat_id, photo=bio)
+        if message.photo:
+            _CACHE[key] = message.photo[-1].file_id
+            if len(_CACHE) > PROMPT_CACHE_SIZE:
+                _CACHE.popitem(last=False)
 
     except Exception as e:
         logger.error(f"An error occurred during image generation or sending: {e}")
-        error_message = (
-            "😥 Sorry, something went wrong.\n\n"
-            "This could be because the prompt was unsafe or the service is busy. "
-            "Please try a different prompt."
-        )
-        await context.bot.send_message(chat_id=chat_id, text=error_message)
-    finally:
-        await context.bot.delete_message(
-            chat_id=chat_id,
-            message_id=processing_message.message_id
-        )
+        try:
+            await bot.send_message(chat_id=chat_id, text=ERROR_TEXT)
+        finally:
+            # Always clear the placeholder, even if the error reply itself fails
+            await bot.delete_message(
+                chat_id=chat_id,
+                message_id=msg_id
+            )
 
 async def post_init(application: Application):
     await application.bot.set_my_commands([
@@ -111,11 +205,39 @@ async def post_init(application: Application):
         BotCommand('/help', 'Get help and tips'),
     ])
     logger.info("Custom bot commands have been set.")
+
+    # Open the connection to the Gemini API before the first prompt arrives.
+    # Imagen models may reject countTokens, but the round-trip still sets up the channel.
+    try:
+        await IMAGEN_MODEL.count_tokens_async("warmup")
+    except Exception as e:
+        logger.debug(f"Gemini API warm-up request was rejected: {e}")
+    logger.info("Gemini API connection warmed up.")
     
+# --- Telegram HTTP client using orjson for response parsing ---
+class OrjsonRequest(HTTPXRequest):
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError as exc:
+            logger.error(f"Can not load invalid JSON data: {payload!r}")
+            raise TelegramError("Invalid server response") from exc
+
 # --- Web Server for Render Health Check ---
 async def health_check(request):
     return web.Response(text="OK")
 
+APPLICATION_KEY = web.AppKey("application", Application)
+
+async def telegram_webhook(request):
+    if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    application = request.app[APPLICATION_KEY]
+    update = Update.de_json(orjson.loads(await request.read()), application.bot)
+    await application.update_queue.put(update)
+    return web.Response()
+
 # <<< CHANGE: MODIFIED MAIN FUNCTION AND SHUTDOWN LOGIC >>>
 async def main() -> None:
     """Set up and run the bot and web server."""
@@ -124,51 +246,59 @@ async def main() -> None:
         return
 
     # Create the Telegram Application
-    application = Application.builder().token(TELEGRAM_TOKEN).post_init(post_init).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .request(OrjsonRequest())
+        .get_updates_request(OrjsonRequest(connection_pool_size=1))
+        .build()
+    )
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, generate_image))
 
     # Set up the web server
     app = web.Application()
+    app[APPLICATION_KEY] = application
     app.router.add_get("/health", health_check)
+    app.router.add_post(WEBHOOK_PATH, telegram_webhook)
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', PORT)
 
     # Get the current asyncio event loop
     loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
 
     # A function to handle graceful shutdown
-    async def shutdown(sig):
+    def shutdown(sig):
         logger.info(f"Received exit signal {sig.name}...")
-        logger.info("Stopping web server...")
-        await runner.cleanup()
-        logger.info("Stopping bot...")
-        await application.updater.stop()
-        await application.stop()
-        logger.info("Cancelling pending tasks...")
-        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
-        [task.cancel() for task in tasks]
-        await asyncio.gather(*tasks, return_exceptions=True)
-        loop.stop()
+        stop_event.set()
 
     # Add signal handlers for graceful shutdown
     for sig in (signal.SIGINT, signal.SIGTERM):
-        loop.add_signal_handler(sig, lambda sig=sig: asyncio.create_task(shutdown(sig)))
+        loop.add_signal_handler(sig, shutdown, sig)
 
     # Start everything
     try:
         logger.info(f"Starting web server on port {PORT}...")
         await site.start()
-        logger.info("Starting bot polling...")
         await application.initialize()
+        await post_init(application)
         await application.start()
-        await application.updater.start_polling()
-        
-        # Keep the main task running
-        while True:
-            await asyncio.sleep(3600) # Sleep for a long time
+        if RENDER_HOST:
+            logger.info("Registering bot webhook...")
+            await application.bot.set_webhook(
+                url=f"https://{RENDER_HOST}{WEBHOOK_PATH}",
+                allowed_updates=Update.ALL_TYPES,
+                secret_token=WEBHOOK_SECRET
+            )
+        else:
+            logger.info("Starting bot polling...")
+            await application.updater.start_polling()
+
+        # Keep the main task running until a shutdown signal arrives
+        await stop_event.wait()
 
     except (KeyboardInterrupt, SystemExit):
         logger.info("Shutdown initiated by user.")
@@ -176,9 +306,17 @@ async def main() -> None:
         logger.critical(f"An unhandled exception occurred: {e}")
     finally:
         logger.info("Application is shutting down.")
-        # The shutdown logic will be handled by the signal handler
+        logger.info("Stopping web server...")
+        await runner.cleanup()
+        logger.info("Stopping bot...")
+        if application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
 
 if __name__ == '__main__':
+    uvloop.install()
     try:
         asyncio.run(main())
     except RuntimeError as e: